@@ -6,9 +6,12 @@ from dotenv import load_dotenv
 import os
 import json
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 import hashlib
+import math
+import threading
+import itertools
 
 load_dotenv()
 
@@ -23,6 +26,122 @@ rooms = {}
 syllabus_storage = {}
 question_history = {}
 chapter_completions = {}
+question_topics = {}
+topic_counts = {}
+counted_wrong_answers = {}
+topic_index_cache = {}
+skill_profiles = {}
+next_targets = {}
+
+BASE_RATING = 1000
+SKILL_K = 32
+MIN_SKILL_ANSWERS = 5
+MAX_SERVED_QUESTIONS = 50
+TARGET_SUCCESS_RATE = 0.7
+DIFFICULTY_RATINGS = {'easy': 700, 'medium': 850, 'hard': 1000}
+
+tutor_sessions = {}
+tutor_lock = threading.Lock()
+inflight_calls = {}
+inflight_lock = threading.Lock()
+
+SINGLE_FLIGHT_MAX_WAITERS = 50
+SINGLE_FLIGHT_TIMEOUT = 30
+
+parse_stats = {}
+
+RESPONSE_SCHEMAS = {
+    'subject_grade': {'subject': str, 'grade': (str, int)},
+    'question': {'question': str, 'options': list, 'correct_index': int, 'explanation': str},
+    'world': {
+        'world_name': str, 'biome_description': str, 'enemies': list,
+        'resources': list, 'quest_title': str, 'quest_description': str
+    },
+    'weak_topics': {'weak_topics': list},
+    'insight': {'insight': str}
+}
+OPTIONAL_RESPONSE_FIELDS = {'explanation'}
+MAX_INVALID_QUESTION_RETRIES = 2
+
+TUTOR_PROMPT_BUDGET = 1400
+TUTOR_HISTORY_BUDGET = 750
+TUTOR_SUMMARY_BUDGET = 250
+TUTOR_MESSAGE_BUDGET = 300
+TUTOR_MAX_TURNS = 12
+TUTOR_SESSION_TTL = 3600
+TUTOR_MAX_SESSIONS = 1000
+
+SUBJECT_TOPICS = {
+    'Math': {
+        'Addition': ['add', 'addition', 'sum', 'plus', 'total', 'altogether'],
+        'Subtraction': ['subtract', 'subtraction', 'minus', 'difference', 'left', 'remain', 'fewer'],
+        'Multiplication': ['multiply', 'multiplication', 'times', 'product', 'multiple', 'multiples'],
+        'Division': ['divide', 'division', 'divided', 'quotient', 'remainder', 'share', 'equally'],
+        'Fractions': ['fraction', 'fractions', 'numerator', 'denominator', 'half', 'quarter', 'third'],
+        'Decimals': ['decimal', 'decimals', 'tenths', 'hundredths', 'point'],
+        'Percentages': ['percent', 'percentage', 'discount', 'interest'],
+        'Geometry': ['angle', 'triangle', 'circle', 'square', 'rectangle', 'area', 'perimeter', 'shape', 'polygon', 'volume', 'radius'],
+        'Algebra': ['solve', 'equation', 'variable', 'expression', 'x', 'y', 'unknown', 'linear'],
+        'Measurement': ['length', 'weight', 'mass', 'meter', 'metre', 'kilogram', 'litre', 'liter', 'unit', 'convert'],
+        'Time and Money': ['time', 'clock', 'hour', 'minute', 'money', 'coin', 'cost', 'price', 'dollar']
+    },
+    'Science': {
+        'Plants': ['plant', 'plants', 'photosynthesis', 'leaf', 'leaves', 'root', 'chlorophyll', 'seed', 'flower'],
+        'Animals': ['animal', 'animals', 'mammal', 'reptile', 'bird', 'insect', 'habitat', 'predator', 'vertebrate'],
+        'Human Body': ['body', 'heart', 'blood', 'lung', 'lungs', 'bone', 'bones', 'organ', 'digestion', 'brain', 'muscle'],
+        'Matter': ['matter', 'solid', 'liquid', 'gas', 'boil', 'boiling', 'melt', 'freeze', 'evaporation', 'state'],
+        'Chemistry': ['atom', 'molecule', 'element', 'compound', 'chemical', 'formula', 'reaction', 'acid', 'base'],
+        'Forces and Motion': ['force', 'gravity', 'motion', 'friction', 'speed', 'push', 'pull', 'newton', 'mass'],
+        'Energy': ['energy', 'heat', 'light', 'electricity', 'circuit', 'battery', 'sound', 'magnet'],
+        'Earth and Space': ['earth', 'planet', 'sun', 'moon', 'star', 'solar', 'orbit', 'weather', 'rock', 'volcano']
+    },
+    'History': {
+        'Ancient Civilizations': ['ancient', 'egypt', 'pharaoh', 'rome', 'roman', 'greece', 'greek', 'mesopotamia', 'pyramid'],
+        'Medieval Period': ['medieval', 'knight', 'castle', 'king', 'feudal', 'crusade', 'viking'],
+        'World Wars': ['war', 'wwi', 'wwii', 'world', 'treaty', 'versailles', 'allies', 'hitler', 'battle'],
+        'American History': ['america', 'american', 'president', 'washington', 'independence', 'constitution', 'colony', 'colonies'],
+        'Revolutions': ['revolution', 'revolutionary', 'french', 'industrial', 'independence', 'rebellion'],
+        'Exploration': ['explorer', 'exploration', 'columbus', 'voyage', 'discover', 'discovered', 'trade', 'route']
+    },
+    'Geography': {
+        'Continents and Countries': ['continent', 'continents', 'country', 'countries', 'capital', 'nation', 'border'],
+        'Rivers and Oceans': ['river', 'ocean', 'sea', 'lake', 'water', 'nile', 'amazon', 'pacific', 'atlantic'],
+        'Landforms': ['mountain', 'mountains', 'desert', 'plateau', 'valley', 'island', 'volcano', 'plain'],
+        'Climate and Weather': ['climate', 'weather', 'rain', 'temperature', 'season', 'monsoon', 'tropical'],
+        'Maps and Directions': ['map', 'maps', 'compass', 'latitude', 'longitude', 'equator', 'hemisphere', 'direction'],
+        'Population and Resources': ['population', 'city', 'cities', 'resource', 'resources', 'agriculture', 'industry']
+    },
+    'English': {
+        'Grammar': ['noun', 'verb', 'adjective', 'adverb', 'pronoun', 'tense', 'past', 'present', 'sentence', 'grammar'],
+        'Vocabulary': ['synonym', 'antonym', 'meaning', 'word', 'opposite', 'definition', 'vocabulary'],
+        'Spelling': ['spell', 'spelling', 'spelled', 'letter', 'letters', 'correct'],
+        'Punctuation': ['punctuation', 'comma', 'period', 'apostrophe', 'question', 'mark', 'quotation'],
+        'Reading Comprehension': ['story', 'passage', 'character', 'main', 'idea', 'author', 'poem', 'theme'],
+        'Figures of Speech': ['simile', 'metaphor', 'personification', 'alliteration', 'rhyme', 'idiom']
+    }
+}
+
+STOPWORDS = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'of', 'to', 'in', 'on', 'at', 'for', 'and', 'or',
+    'what', 'which', 'who', 'whom', 'how', 'why', 'when', 'where', 'does', 'do', 'did', 'this', 'that',
+    'these', 'those', 'it', 'its', 'be', 'by', 'with', 'from', 'as', 'if', 'has', 'have', 'had', 'can',
+    'will', 'would', 'should', 'following', 'called', 'chapter', 'unit', 'lesson', 'module'
+}
+
+MAX_CACHED_QUESTION_TOPICS = 5000
+MAX_COUNTED_WRONG_ANSWERS = 500
+
+OPERATOR_WORDS = [
+    (r'(?<=\d)/(?=\d)', ' fraction '),
+    (r'/', ' divide '),
+    (r'(?<=[\d\s])-(?=[\d\s])', ' minus '),
+    (r'\+', ' plus '),
+    (r'[×*]', ' times '),
+    (r'(?<=\d)\s*x\s*(?=\d)', ' times '),
+    (r'÷', ' divide '),
+    (r'%', ' percent '),
+    (r'(?<=\d)(?=[a-z])', ' ')
+]
 
 def extract_text_from_pdf_content(content):
     text = ""
@@ -95,6 +214,434 @@ def get_question_hash(question_text, options):
     content = f"{question_text}_{'_'.join(options)}"
     return hashlib.md5(content.encode()).hexdigest()
 
+def tokenize_topic_text(text):
+    text = str(text).lower()
+    for pattern, word in OPERATOR_WORDS:
+        text = re.sub(pattern, word, text)
+    tokens = re.findall(r'[a-z0-9]+', text)
+    return [t for t in tokens if t not in STOPWORDS]
+
+def get_topic_index_key(subject, syllabus_id=None):
+    return f"syllabus_{syllabus_id}" if syllabus_id in syllabus_storage else f"subject_{subject}"
+
+def get_question_text_key(question_text, index_key):
+    return f"{index_key}_{hashlib.md5(str(question_text).strip().lower().encode()).hexdigest()}"
+
+def build_topic_index(subject, syllabus_id=None):
+    cache_key = get_topic_index_key(subject, syllabus_id)
+    if cache_key in topic_index_cache:
+        return topic_index_cache[cache_key]
+    
+    topic_docs = {}
+    if syllabus_id in syllabus_storage:
+        for chapter in syllabus_storage[syllabus_id].get('chapters', []):
+            # Chapter titles weigh more than body text
+            title = chapter.get('title', '')
+            topic_docs[title] = tokenize_topic_text(title) * 3 + tokenize_topic_text(chapter.get('content', ''))
+    else:
+        # Unknown subjects get an empty index rather than another subject's topics
+        for topic, keywords in SUBJECT_TOPICS.get(subject, {}).items():
+            topic_docs[topic] = tokenize_topic_text(topic) + keywords
+    
+    doc_freq = {}
+    for tokens in topic_docs.values():
+        for token in set(tokens):
+            doc_freq[token] = doc_freq.get(token, 0) + 1
+    
+    total_docs = len(topic_docs)
+    vectors = {}
+    for topic, tokens in topic_docs.items():
+        vector = {}
+        for token in tokens:
+            vector[token] = vector.get(token, 0) + 1
+        for token in vector:
+            vector[token] = vector[token] * (math.log((1 + total_docs) / (1 + doc_freq[token])) + 1)
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        vectors[topic] = {token: w / norm for token, w in vector.items()}
+    
+    topic_index_cache[cache_key] = vectors
+    return vectors
+
+def score_topics(text, subject, syllabus_id=None, max_topics=2):
+    tokens = tokenize_topic_text(text)
+    scores = {}
+    for topic, vector in build_topic_index(subject, syllabus_id).items():
+        score = sum(vector.get(token, 0) for token in tokens)
+        if score > 0:
+            scores[topic] = score
+    return sorted(scores, key=scores.get, reverse=True)[:max_topics]
+
+def cache_question_topics(key, topics):
+    question_topics[key] = topics
+    # Oldest entries go first once the cache is full
+    while len(question_topics) > MAX_CACHED_QUESTION_TOPICS:
+        del question_topics[next(iter(question_topics))]
+
+def classify_question_topics(question_text, subject, syllabus_id=None):
+    key = get_question_text_key(question_text, get_topic_index_key(subject, syllabus_id))
+    if key not in question_topics:
+        cache_question_topics(key, score_topics(question_text, subject, syllabus_id))
+    return question_topics[key]
+
+def tag_question(question_data, subject, syllabus_id=None):
+    # The explanation helps tagging, but answers are looked up by question text alone
+    topics = score_topics(f"{question_data.get('question', '')} {question_data.get('explanation', '')}", subject, syllabus_id)
+    cache_question_topics(get_question_text_key(question_data.get('question', ''), get_topic_index_key(subject, syllabus_id)), topics)
+    return topics
+
+def record_wrong_topics(user_key, question_key, topics):
+    # The client resends its whole list of wrong answers, so count each question once
+    counted = counted_wrong_answers.setdefault(user_key, {})
+    if question_key in counted:
+        return
+    counted[question_key] = True
+    while len(counted) > MAX_COUNTED_WRONG_ANSWERS:
+        del counted[next(iter(counted))]
+    
+    if user_key not in topic_counts:
+        topic_counts[user_key] = {}
+    for topic in topics:
+        topic_counts[user_key][topic] = topic_counts[user_key].get(topic, 0) + 1
+
+def get_weak_topics(user_key, limit=5):
+    counts = topic_counts.get(user_key, {})
+    return sorted(counts, key=counts.get, reverse=True)[:limit]
+
+def get_skill_profile(user_id, subject):
+    skill_key = f"{user_id}_{subject}"
+    if skill_key not in skill_profiles:
+        skill_profiles[skill_key] = {
+            'rating': BASE_RATING,
+            'answers': 0,
+            'topics': {},
+            'served': [],
+            'session_answers': 0,
+            'session_correct': 0
+        }
+    return skill_profiles[skill_key]
+
+def record_served_question(user_id, subject, question_text, difficulty, topics):
+    profile = get_skill_profile(user_id, subject)
+    profile['served'].append({
+        'question_key': get_question_text_key(question_text, subject),
+        'difficulty': difficulty,
+        'topics': topics
+    })
+    del profile['served'][:-MAX_SERVED_QUESTIONS]
+
+def pop_served_question(profile, question_text, subject):
+    question_key = get_question_text_key(question_text, subject)
+    for i, served in enumerate(profile['served']):
+        if served['question_key'] == question_key:
+            return profile['served'].pop(i)
+    return None
+
+def serve_question(question_data, user_id, subject, syllabus_id, difficulty):
+    # Remember what was served so answers can be scored at the right difficulty
+    question_data['topics'] = tag_question(question_data, subject, syllabus_id)
+    question_data['difficulty'] = difficulty
+    if user_id != 'anonymous':
+        record_served_question(user_id, subject, question_data.get('question', ''), difficulty, question_data['topics'])
+    return question_data
+
+def fold_chapter_answers(user_id, subject, syllabus_id, answers, total_questions, correct_answers):
+    # Fold in answers that were not already reported one by one over the socket
+    profile = get_skill_profile(user_id, subject)
+    if answers:
+        # Per-question results let each topic be scored on its own answers
+        for answer in answers[profile['session_answers']:]:
+            question_text = answer.get('question') or ''
+            served = pop_served_question(profile, question_text, subject) if question_text else None
+            if served is None:
+                served = {'difficulty': answer.get('difficulty') or 'medium', 'topics': classify_question_topics(question_text, subject, syllabus_id)}
+            update_skill(user_id, subject, int(bool(answer.get('correct'))), [served])
+    else:
+        remaining = max(0, int(total_questions or 0) - profile['session_answers'])
+        if remaining:
+            remaining_correct = min(remaining, max(0, int(correct_answers or 0) - profile['session_correct']))
+            served = profile['served'][-remaining:]
+            served = [{'difficulty': 'medium', 'topics': []}] * (remaining - len(served)) + served
+            update_skill(user_id, subject, remaining_correct, served)
+    profile['served'] = []
+    profile['session_answers'] = 0
+    profile['session_correct'] = 0
+
+def expected_success(rating, difficulty):
+    return 1 / (1 + 10 ** ((DIFFICULTY_RATINGS.get(difficulty, BASE_RATING) - rating) / 400))
+
+def compute_next_target(profile):
+    # Pick the difficulty the student is most likely to get right ~70% of the time
+    difficulty = min(
+        DIFFICULTY_RATINGS,
+        key=lambda d: abs(expected_success(profile['rating'], d) - TARGET_SUCCESS_RATE)
+    )
+    # Topics are ranked by their own rating, lowest first
+    focus_topics = sorted(profile['topics'], key=profile['topics'].get)[:3]
+    return {'difficulty': difficulty, 'focus_topics': focus_topics}
+
+def update_skill(user_id, subject, correct, served):
+    profile = get_skill_profile(user_id, subject)
+    # Elo update over the served questions; correct is how many of them were right.
+    # Per-question correctness is unknown in a batch, so topics share the batch score.
+    score = correct / len(served)
+    expected_total = 0
+    for question in served:
+        expected_total += expected_success(profile['rating'], question['difficulty'])
+        for topic in question['topics']:
+            topic_rating = profile['topics'].get(topic, profile['rating'])
+            profile['topics'][topic] = topic_rating + SKILL_K * (score - expected_success(topic_rating, question['difficulty']))
+    profile['rating'] += SKILL_K * (correct - expected_total)
+    profile['answers'] += len(served)
+    next_targets[f"{user_id}_{subject}"] = compute_next_target(profile)
+    return profile
+
+def estimate_tokens(text):
+    # Words, numbers and punctuation each count as a token; long words as roughly 4 characters per token
+    return sum(max(1, math.ceil(len(piece) / 4)) for piece in re.findall(r"\w+|[^\w\s]", str(text)))
+
+def truncate_to_tokens(text, budget):
+    pieces = re.findall(r"\S+\s*", str(text))
+    kept = []
+    used = 0
+    for piece in pieces:
+        cost = estimate_tokens(piece)
+        if used + cost > budget:
+            # Hard-cut an oversized piece (long URL, pasted equation) rather than dropping it
+            low, high = 0, len(piece)
+            while low < high:
+                mid = (low + high + 1) // 2
+                if estimate_tokens(piece[:mid]) <= budget - used:
+                    low = mid
+                else:
+                    high = mid - 1
+            kept.append(piece[:low])
+            break
+        kept.append(piece)
+        used += cost
+    return ''.join(kept).strip()
+
+def evict_tutor_sessions():
+    # Sessions are kept in least-recently-used order, so expired ones sit at the front
+    cutoff = datetime.now() - timedelta(seconds=TUTOR_SESSION_TTL)
+    while tutor_sessions:
+        oldest_id = next(iter(tutor_sessions))
+        if len(tutor_sessions) <= TUTOR_MAX_SESSIONS and datetime.fromisoformat(tutor_sessions[oldest_id]['updated_at']) >= cutoff:
+            break
+        tutor_sessions.pop(oldest_id, None)
+
+def get_tutor_session(session_id, chat_history=None):
+    # Returns the session and whether it had to be (re)created
+    with tutor_lock:
+        session = tutor_sessions.pop(session_id, None)
+        is_new = session is None
+        if is_new:
+            session = {'turns': [], 'summary': [], 'updated_at': datetime.now().isoformat()}
+            # Seed from the client's recent history when the server has no record of it
+            for msg in (chat_history or [])[-TUTOR_MAX_TURNS:]:
+                add_tutor_turn(session, msg.get('role', 'user'), msg.get('content', ''))
+            compact_tutor_session(session)
+        session['updated_at'] = datetime.now().isoformat()
+        tutor_sessions[session_id] = session
+        evict_tutor_sessions()
+    return session, is_new
+
+def add_tutor_turn(session, role, content):
+    content = truncate_to_tokens(content, TUTOR_MESSAGE_BUDGET)
+    session['turns'].append({'role': role, 'content': content, 'tokens': estimate_tokens(f"{role}: {content}")})
+
+def summarize_turn(turn):
+    first_sentence = re.split(r'(?<=[.!?])\s', turn['content'].strip(), maxsplit=1)[0]
+    speaker = 'Student asked' if turn['role'] == 'user' else 'Tutor explained'
+    return f"{speaker}: {truncate_to_tokens(first_sentence, 40)}"
+
+def compact_tutor_session(session):
+    # Fold the oldest turns into the rolling summary so stored history stays within budget
+    while len(session['turns']) > TUTOR_MAX_TURNS or sum(t['tokens'] for t in session['turns']) > TUTOR_HISTORY_BUDGET:
+        session['summary'].append(summarize_turn(session['turns'].pop(0)))
+    while session['summary'] and estimate_tokens(' '.join(session['summary'])) > TUTOR_SUMMARY_BUDGET:
+        session['summary'].pop(0)
+
+def build_tutor_prompt(session, subject, grade, message):
+    header = f"""You are a warm, encouraging AI tutor for a grade {grade} student learning {subject}.
+Keep explanations short, fun, and age-appropriate. Use emojis occasionally.
+Be supportive and patient."""
+    summary = '\n'.join(session['summary'])
+    if summary:
+        header += f"\nSummary of earlier conversation:\n{summary}"
+    footer = f"User: {message}\nTutor:"
+    
+    budget = TUTOR_PROMPT_BUDGET - estimate_tokens(header) - estimate_tokens(footer)
+    history_lines = []
+    for turn in reversed(session['turns']):
+        if turn['tokens'] > budget:
+            break
+        history_lines.insert(0, f"{turn['role']}: {turn['content']}")
+        budget -= turn['tokens']
+    
+    history_str = '\n'.join(history_lines)
+    return f"""{header}
+Previous conversation:
+{history_str}
+{footer}"""
+
+def groq_completion(prompt, temperature, max_tokens):
+    response = groq_client.chat.completions.create(
+        model="llama-3.3-70b-versatile",
+        messages=[{"role": "user", "content": prompt}],
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+    return response.choices[0].message.content
+
+def coalesced_groq_completion(prompt, temperature, max_tokens):
+    # Identical in-flight prompts share a single upstream call; once a flight has
+    # SINGLE_FLIGHT_MAX_WAITERS waiters, later callers start or join the next flight
+    key = hashlib.md5(f"{temperature}_{max_tokens}_{prompt}".encode()).hexdigest()
+    with inflight_lock:
+        flight = 0
+        while True:
+            flight_key = f"{key}_{flight}"
+            call = inflight_calls.get(flight_key)
+            if call is None:
+                call = {'event': threading.Event(), 'result': None, 'error': None, 'waiters': 0}
+                inflight_calls[flight_key] = call
+                is_leader = True
+                break
+            if call['waiters'] < SINGLE_FLIGHT_MAX_WAITERS:
+                call['waiters'] += 1
+                is_leader = False
+                break
+            flight += 1
+    
+    if is_leader:
+        try:
+            call['result'] = groq_completion(prompt, temperature, max_tokens)
+        except Exception as e:
+            call['error'] = e
+        finally:
+            with inflight_lock:
+                inflight_calls.pop(flight_key, None)
+            call['event'].set()
+        if call['waiters']:
+            print(f"[DEBUG] Single-flight shared one call with {call['waiters']} waiters")
+        if call['error']:
+            raise call['error']
+        return call['result']
+    
+    if not call['event'].wait(SINGLE_FLIGHT_TIMEOUT):
+        raise TimeoutError(f"Timed out waiting for in-flight request {flight_key}")
+    if call['error']:
+        # Each waiter gets its own exception rather than sharing the leader's
+        raise RuntimeError(f"Shared request {flight_key} failed: {call['error']}") from call['error']
+    return call['result']
+
+def iter_json_objects(text):
+    # Single pass over the text yielding each top-level {...} block, plus a
+    # closed-off version of a trailing block that was cut short
+    start = None
+    stack = []
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"' and start is not None:
+            in_string = True
+        elif ch in '{[':
+            if ch == '{' and start is None:
+                start = i
+            if start is not None:
+                stack.append('}' if ch == '{' else ']')
+        elif ch in '}]' and stack:
+            stack.pop()
+            if not stack:
+                yield text[start:i + 1], False
+                start = None
+    if start is not None:
+        tail = text[start:].rstrip().rstrip(',')
+        yield tail + ('"' if in_string else '') + ''.join(reversed(stack)), True
+
+JSON_STRING = r'"(?:\\.|[^"\\])*"'
+
+def remove_trailing_commas(text):
+    return re.sub(JSON_STRING + r'|,(?=\s*[}\]])', lambda m: m.group(0) if m.group(0) != ',' else '', text)
+
+def fix_smart_quote_delimiters(text):
+    # Only curly quotes sitting where a JSON string opens or closes; quotes inside values are left alone
+    text = re.sub(r'(?<=[{\[,:])(\s*)[“”]', r'\1"', text)
+    return re.sub(r'[“”](?=\s*[,:}\]])', '"', text)
+
+def fix_python_literals(text):
+    literals = {'True': 'true', 'False': 'false', 'None': 'null'}
+    return re.sub(JSON_STRING + r'|\b(?:True|False|None)\b', lambda m: literals.get(m.group(0), m.group(0)), text)
+
+JSON_REPAIR_STAGES = [remove_trailing_commas, fix_smart_quote_delimiters, fix_python_literals]
+
+def iter_json_repairs(text):
+    # Cheapest, safest repairs first; each stage builds on the previous one
+    for repair in JSON_REPAIR_STAGES:
+        repaired = repair(text)
+        if repaired != text:
+            text = repaired
+            yield text
+
+def validate_response(data, schema_name):
+    if not isinstance(data, dict):
+        return None, False
+    
+    repaired = False
+    for field, field_type in RESPONSE_SCHEMAS[schema_name].items():
+        value = data.get(field)
+        if value is None:
+            if field not in OPTIONAL_RESPONSE_FIELDS:
+                return None, False
+            data[field] = field_type()
+            repaired = True
+        elif field_type is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+            data[field] = str(value)
+            repaired = True
+        elif field_type is int and isinstance(value, str) and re.fullmatch(r'\d+', value.strip(), re.ASCII):
+            data[field] = int(value.strip())
+            repaired = True
+        elif not isinstance(value, field_type) or isinstance(value, bool):
+            return None, False
+    
+    if schema_name == 'question':
+        if len(data['options']) != 4 or not 0 <= data['correct_index'] < 4:
+            return None, False
+        if not all(isinstance(option, str) for option in data['options']):
+            data['options'] = [str(option) for option in data['options']]
+            repaired = True
+    
+    return data, repaired
+
+def parse_llm_json(content, schema_name):
+    stats = parse_stats.setdefault(schema_name, {'total': 0, 'parsed': 0, 'repaired': 0, 'failed': 0})
+    stats['total'] += 1
+    
+    text = re.sub(r'```(?:json)?', '', content or '')
+    for candidate, truncated in iter_json_objects(text):
+        for attempt, raw in enumerate(itertools.chain([candidate], iter_json_repairs(candidate))):
+            try:
+                data = json.loads(raw)
+            except json.JSONDecodeError:
+                continue
+            data, coerced = validate_response(data, schema_name)
+            if data is not None:
+                stats['repaired' if attempt or coerced or truncated else 'parsed'] += 1
+                return data
+            break
+    
+    stats['failed'] += 1
+    print(f"[DEBUG] Could not parse {schema_name} response: {str(content)[:100]}")
+    return None
+
 def detect_subject_and_grade(text):
     sample_text = text[:2000]
     
@@ -108,18 +655,10 @@ Content sample:
 Return ONLY valid JSON: {{ "subject": "string", "grade": "number", "reason": "short explanation" }}"""
 
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-            max_tokens=200
-        )
-        content = response.choices[0].message.content
-        json_start = content.find('{')
-        json_end = content.rfind('}') + 1
-        if json_start >= 0 and json_end > json_start:
-            result = json.loads(content[json_start:json_end])
-            return result.get('subject', 'Math'), str(result.get('grade', 5))
+        content = coalesced_groq_completion(prompt, temperature=0.3, max_tokens=200)
+        result = parse_llm_json(content, 'subject_grade')
+        if result:
+            return result['subject'], str(result['grade'])
     except Exception as e:
         print(f"Error detecting subject/grade: {e}")
     
@@ -201,7 +740,14 @@ def generate_question():
     chapter_id = data.get('chapter_id')
     user_id = data.get('user_id', 'anonymous')
     
-    print(f"[DEBUG] Generating question for subject={subject}, grade={grade}, entity={entity_name}")
+    # Prefer the server-side skill model once it has seen enough answers
+    skill_key = f"{user_id}_{subject}"
+    if user_id != 'anonymous' and skill_key in next_targets and skill_profiles[skill_key]['answers'] >= MIN_SKILL_ANSWERS:
+        target = next_targets[skill_key]
+        difficulty = target['difficulty']
+        weak_topics = target['focus_topics'] + [t for t in weak_topics if t not in target['focus_topics']]
+    
+    print(f"[DEBUG] Generating question for subject={subject}, grade={grade}, difficulty={difficulty}, entity={entity_name}")
     
     # Create unique key - include entity so each gets different question
     if syllabus_id and chapter_id:
@@ -215,12 +761,15 @@ def generate_question():
     used_hashes = question_history[user_key]
     
     max_attempts = 15
-    for attempt in range(max_attempts):
+    attempt = 0
+    invalid_replies = 0
+    while attempt < max_attempts:
         weak_topics_str = ", ".join(weak_topics) if weak_topics else "general concepts"
         
         if chapter_content:
             prompt = f"""You are an educational game master. Generate a unique {difficulty} {subject} question for grade {grade} students.
 Based on this chapter content: {chapter_content[:500]}
+Focus on these topics where possible: {weak_topics_str}
 IMPORTANT: Generate a DIFFERENT question from any previous ones.
 Return ONLY valid JSON: {{ "question": "string", "options": ["option1", "option2", "option3", "option4"], "correct_index": 0-3, "explanation": "string" }}
 Make it completely different from any question you've generated before."""
@@ -235,41 +784,39 @@ Make it completely different from any question you've generated before."""
             prompt = f"""You are a {subject} expert teacher. Create a {difficulty} level question about {subject} for grade {grade} students.
 This is a {interaction_desc} with the {entity_name} character.
 The question must be about {subject} - NOT math, NOT any other subject.
+Focus on these topics where possible: {weak_topics_str}
 Return ONLY valid JSON: {{ "question": "string", "options": ["option1", "option2", "option3", "option4"], "correct_index": 0-3, "explanation": "string" }}"""
 
         try:
-            response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.9,
-                max_tokens=500
-            )
-            content = response.choices[0].message.content
-            json_start = content.find('{')
-            json_end = content.rfind('}') + 1
-            if json_start >= 0 and json_end > json_start:
-                question_data = json.loads(content[json_start:json_end])
-            else:
-                print(f"[DEBUG] No valid JSON found in response, using default")
-                question_data = get_default_question(subject, difficulty)
+            content = groq_completion(prompt, temperature=0.9, max_tokens=500)
+            question_data = parse_llm_json(content, 'question')
+            if question_data is None:
+                # Malformed replies get their own small retry budget, separate from duplicate avoidance
+                invalid_replies += 1
+                if invalid_replies > MAX_INVALID_QUESTION_RETRIES:
+                    print(f"[DEBUG] Repeated invalid questions, using default for {subject}")
+                    return jsonify(serve_question(get_default_question(subject, difficulty), user_id, subject, syllabus_id, difficulty))
+                print(f"[DEBUG] No valid question in response, trying again")
+                continue
+            attempt += 1
             
             q_hash = get_question_hash(question_data.get('question', ''), question_data.get('options', []))
             
             if q_hash not in used_hashes:
                 question_history[user_key].append(q_hash)
                 print(f"[DEBUG] Returning question: {question_data.get('question', '')[:50]}...")
-                return jsonify(question_data)
+                return jsonify(serve_question(question_data, user_id, subject, syllabus_id, difficulty))
             else:
                 print(f"[DEBUG] Question already used, trying again")
             
         except Exception as e:
             print(f"[ERROR] Error generating question: {e}")
-            return jsonify(get_default_question(subject, difficulty))
+            return jsonify(serve_question(get_default_question(subject, difficulty), user_id, subject, syllabus_id, difficulty))
     
-    # If all attempts failed to generate unique question, clear history and try again
+    # If all attempts failed to generate a valid, unique question, clear history and use the default
     print(f"[DEBUG] All attempts failed, using default for {subject}")
     question_history[user_key] = []
-    return jsonify(get_default_question(subject, difficulty))
+    return jsonify(serve_question(get_default_question(subject, difficulty), user_id, subject, syllabus_id, difficulty))
 
 @app.route('/api/complete-chapter', methods=['POST'])
 def complete_chapter():
@@ -307,6 +854,9 @@ def complete_chapter():
         'completed_at': datetime.now().isoformat()
     }
     
+    if user_id != 'anonymous':
+        fold_chapter_answers(user_id, subject, syllabus_id, data.get('answers') or [], total_questions, correct_answers)
+    
     key = f"{user_id}_{syllabus_id}_{chapter_id}" if syllabus_id else f"{user_id}_{subject}_default"
     print(f"[DEBUG] Storage key: {key}")
     chapter_completions[key] = completion
@@ -403,6 +953,29 @@ def get_chapter_progress():
         'total_chapters': total
     })
 
+@app.route('/api/get-skill-profile', methods=['GET'])
+def get_skill_profile_route():
+    user_id = request.args.get('user_id', 'anonymous')
+    subject = request.args.get('subject', 'Math')
+    
+    profile = get_skill_profile(user_id, subject)
+    target = next_targets.get(f"{user_id}_{subject}", compute_next_target(profile))
+    
+    return jsonify({
+        'rating': round(profile['rating']),
+        'answers': profile['answers'],
+        'topics': {t: round(r) for t, r in profile['topics'].items()},
+        'next_target': target
+    })
+
+@app.route('/api/parse-stats', methods=['GET'])
+def get_parse_stats():
+    stats = {}
+    for schema_name, counts in parse_stats.items():
+        stats[schema_name] = dict(counts)
+        stats[schema_name]['failure_rate'] = round(counts['failed'] / counts['total'], 3) if counts['total'] else 0
+    return jsonify(stats)
+
 @app.route('/api/generate-world', methods=['POST'])
 def generate_world():
     data = request.json
@@ -413,19 +986,8 @@ def generate_world():
 Return ONLY valid JSON: {{ "world_name": "string", "biome_description": "string", "enemies": ["enemy1", "enemy2", "enemy3"], "resources": ["resource1", "resource2", "resource3"], "quest_title": "string", "quest_description": "string" }}"""
 
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=500
-        )
-        content = response.choices[0].message.content
-        json_start = content.find('{')
-        json_end = content.rfind('}') + 1
-        if json_start >= 0 and json_end > json_start:
-            world_data = json.loads(content[json_start:json_end])
-        else:
-            world_data = get_default_world(subject)
+        content = coalesced_groq_completion(prompt, temperature=0.7, max_tokens=500)
+        world_data = parse_llm_json(content, 'world') or get_default_world(subject)
         return jsonify(world_data)
     except Exception as e:
         print(f"Error generating world: {e}")
@@ -588,33 +1150,26 @@ def tutor_chat():
     data = request.json
     subject = data.get('subject', 'Math')
     grade = data.get('grade', '5')
-    message = data.get('message', '')
-    chat_history = data.get('chat_history', [])
+    message = truncate_to_tokens(data.get('message', ''), TUTOR_MESSAGE_BUDGET)
+    requested_session_id = data.get('session_id')
+    session_id = requested_session_id or str(uuid.uuid4())
+    session, is_new = get_tutor_session(session_id, data.get('chat_history', []))
+    # Tell the client when a session it expected has expired so it can resend its history
+    session_reset = bool(requested_session_id) and is_new
 
-    history_str = ""
-    for msg in chat_history[-5:]:
-        role = msg.get('role', 'user')
-        history_str += f"{role}: {msg.get('content', '')}\n"
-
-    prompt = f"""You are a warm, encouraging AI tutor for a grade {grade} student learning {subject}.
-Keep explanations short, fun, and age-appropriate. Use emojis occasionally.
-Be supportive and patient. Previous conversation:
-{history_str}
-User: {message}
-Tutor:"""
+    prompt = build_tutor_prompt(session, subject, grade, message)
 
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.8,
-            max_tokens=300
-        )
-        reply = response.choices[0].message.content
-        return jsonify({"reply": reply})
+        reply = groq_completion(prompt, temperature=0.8, max_tokens=300)
+        with tutor_lock:
+            add_tutor_turn(session, 'user', message)
+            add_tutor_turn(session, 'tutor', reply)
+            session['updated_at'] = datetime.now().isoformat()
+            compact_tutor_session(session)
+        return jsonify({"reply": reply, "session_id": session_id, "session_reset": session_reset})
     except Exception as e:
         print(f"Error in tutor chat: {e}")
-        return jsonify({"reply": "I'm here to help! Ask me anything about " + subject + "!"})
+        return jsonify({"reply": "I'm here to help! Ask me anything about " + subject + "!", "session_id": session_id, "session_reset": session_reset})
 
 @app.route('/api/analyze-session', methods=['POST'])
 def analyze_session():
@@ -622,9 +1177,28 @@ def analyze_session():
     subject = data.get('subject', 'Math')
     grade = data.get('grade', '5')
     wrong_answers = data.get('wrong_answers', [])
+    user_id = data.get('user_id', 'anonymous')
+    syllabus_id = data.get('syllabus_id')
+    refine = data.get('refine', False)
+
+    user_key = f"{user_id}_{syllabus_id or subject}"
+    if user_id == 'anonymous':
+        # Anonymous players share one id, so only count this session
+        topic_counts.pop(user_key, None)
+        counted_wrong_answers.pop(user_key, None)
 
     if not wrong_answers:
-        return jsonify({"weak_topics": []})
+        return jsonify({"weak_topics": get_weak_topics(user_key)})
+
+    # Tag wrong answers against the local topic index and keep running per-user counts
+    index_key = get_topic_index_key(subject, syllabus_id)
+    for question_text in wrong_answers:
+        question_key = get_question_text_key(question_text, index_key)
+        record_wrong_topics(user_key, question_key, classify_question_topics(question_text, subject, syllabus_id))
+    weak_topics = get_weak_topics(user_key)
+
+    if not refine:
+        return jsonify({"weak_topics": weak_topics})
 
     wrong_str = ", ".join(wrong_answers[:10])
 
@@ -632,23 +1206,12 @@ def analyze_session():
 Identify up to 5 weak topic areas. Return ONLY valid JSON: {{ "weak_topics": ["topic1", "topic2", "topic3"] }}"""
 
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5,
-            max_tokens=300
-        )
-        content = response.choices[0].message.content
-        json_start = content.find('{')
-        json_end = content.rfind('}') + 1
-        if json_start >= 0 and json_end > json_start:
-            result = json.loads(content[json_start:json_end])
-        else:
-            result = {"weak_topics": []}
+        content = coalesced_groq_completion(prompt, temperature=0.5, max_tokens=300)
+        result = parse_llm_json(content, 'weak_topics') or {"weak_topics": weak_topics}
         return jsonify(result)
     except Exception as e:
         print(f"Error analyzing session: {e}")
-        return jsonify({"weak_topics": []})
+        return jsonify({"weak_topics": weak_topics})
 
 @app.route('/api/class-insight', methods=['POST'])
 def class_insight():
@@ -672,19 +1235,8 @@ Write 3-4 sentences of actionable insight for their teacher about common weak ar
 Return ONLY valid JSON: {{ "insight": "string" }}"""
 
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=300
-        )
-        content = response.choices[0].message.content
-        json_start = content.find('{')
-        json_end = content.rfind('}') + 1
-        if json_start >= 0 and json_end > json_start:
-            result = json.loads(content[json_start:json_end])
-        else:
-            result = {"insight": "Your class is making great progress! Keep up the excellent work."}
+        content = coalesced_groq_completion(prompt, temperature=0.7, max_tokens=300)
+        result = parse_llm_json(content, 'insight') or {"insight": "Your class is making great progress! Keep up the excellent work."}
         return jsonify(result)
     except Exception as e:
         print(f"Error generating class insight: {e}")
@@ -700,6 +1252,8 @@ def handle_join_room(data):
     
     if room_code not in rooms:
         rooms[room_code] = {'players': {}, 'scores': {}}
+    if data.get('syllabus_id'):
+        rooms[room_code]['syllabus_id'] = data.get('syllabus_id')
     
     rooms[room_code]['players'][user_id] = {
         'username': username,
@@ -723,6 +1277,20 @@ def handle_player_answered(data):
     user_id = data.get('user_id')
     correct = data.get('correct', False)
     username = data.get('username', 'Player')
+    subject = data.get('subject')
+    question_text = data.get('question', '')
+    syllabus_id = data.get('syllabus_id') or rooms.get(room_code, {}).get('syllabus_id')
+    
+    # Without a subject we cannot tell which rating the answer belongs to
+    if user_id and subject:
+        profile = get_skill_profile(user_id, subject)
+        served = pop_served_question(profile, question_text, subject) if question_text else None
+        if served is None:
+            topics = classify_question_topics(question_text, subject, syllabus_id) if question_text else []
+            served = {'difficulty': data.get('difficulty', 'medium'), 'topics': topics}
+        update_skill(user_id, subject, int(bool(correct)), [served])
+        profile['session_answers'] += 1
+        profile['session_correct'] += int(bool(correct))
     
     if room_code in rooms and user_id in rooms[room_code]['players']:
         if correct:
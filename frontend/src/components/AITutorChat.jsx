@@ -9,7 +9,9 @@ export default function AITutorChat({ onClose }) {
     chatHistory, 
     addChatMessage, 
     clearChatHistory,
-    sessionData 
+    sessionData,
+    tutorSessionId,
+    setTutorSessionId
   } = useGameStore()
   
   const [message, setMessage] = useState('')
@@ -36,11 +38,14 @@ export default function AITutorChat({ onClose }) {
           subject: sessionData?.subject || 'Math',
           grade: sessionData?.grade || '5',
           message: userMessage,
-          chat_history: chatHistory.slice(-10)
+          session_id: tutorSessionId,
+          // A short tail lets the server rebuild the session if it has expired
+          chat_history: chatHistory.slice(tutorSessionId ? -4 : -10)
         })
       })
       
       const data = await response.json()
+      if (data.session_id) setTutorSessionId(data.session_id)
       addChatMessage('tutor', data.reply)
     } catch (error) {
       console.error('Error in tutor chat:', error)
@@ -13,6 +13,7 @@ export default function QuestionModal() {
     addXp,
     addCorrectAnswer,
     addWrongAnswer,
+    logAnswer,
     takeDamage,
     heal,
     difficulty,
@@ -108,10 +109,12 @@ export default function QuestionModal() {
     setSelectedAnswer(index)
     
     const isCorrect = index === currentQuestion.correct_index
+    const questionDifficulty = currentQuestion.difficulty || difficulty
+    logAnswer(currentQuestion.question, questionDifficulty, isCorrect)
     
     if (isCorrect) {
       setFeedback('Correct! 🎉')
-      const xpGain = GAME_CONFIG.XP_REWARDS[difficulty] || GAME_CONFIG.XP_REWARDS.medium
+      const xpGain = GAME_CONFIG.XP_REWARDS[questionDifficulty] || GAME_CONFIG.XP_REWARDS.medium
       
       const currentCorrect = useGameStore.getState().playerStats.correctAnswers
       const currentTotal = useGameStore.getState().playerStats.totalQuestions
@@ -149,6 +152,7 @@ export default function QuestionModal() {
     setFeedback("Time's up!")
     takeDamage(GAME_CONFIG.DAMAGE_TIMEOUT)
     addWrongAnswer(currentQuestion?.question)
+    if (currentQuestion) logAnswer(currentQuestion.question, currentQuestion.difficulty || difficulty, false)
     setShowResult(true)
     setTimerActive(false)
     
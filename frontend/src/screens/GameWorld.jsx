@@ -428,7 +428,8 @@ export default function GameWorld() {
     isMultiplayer,
     setCurrentChapter,
     syllabusData,
-    setSession
+    setSession,
+    answerLog
   } = useGameStore()
 
   const [showChat, setShowChat] = useState(false)
@@ -581,7 +582,8 @@ export default function GameWorld() {
             time_taken: timeTaken,
             mode: sessionData?.mode || 'default',
             subject: sessionData?.subject,
-            grade: sessionData?.grade
+            grade: sessionData?.grade,
+            answers: answerLog
           })
         })
         if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`)
@@ -593,7 +595,7 @@ export default function GameWorld() {
       
       setShowChapterResult(true)
     }
-  }, [attemptedEntities, chapterStartTime, playerStats, sessionData, user])
+  }, [attemptedEntities, chapterStartTime, playerStats, sessionData, user, answerLog])
 
   const handleContinueToNextChapter = () => {
     const nextChapter = (sessionData?.chapterId || 0) + 1
@@ -19,6 +19,7 @@ export const useGameStore = create((set, get) => ({
   sessionData: null,
   playerStats: { ...basePlayerStats },
   chatHistory: [],
+  tutorSessionId: null,
   weakTopics: [],
   difficulty: 'medium',
   roomCode: null,
@@ -30,6 +31,7 @@ export const useGameStore = create((set, get) => ({
   currentEntity: null,
   questionTimer: GAME_CONFIG.QUESTION_TIMER,
   wrongAnswers: [],
+  answerLog: [],
   loadingQuestion: false,
   completedEntities: [],
   attemptedEntities: [],
@@ -94,6 +96,10 @@ export const useGameStore = create((set, get) => ({
     wrongAnswers: [...state.wrongAnswers, question]
   })),
 
+  logAnswer: (question, difficulty, correct) => set((state) => ({
+    answerLog: [...state.answerLog, { question, difficulty, correct }]
+  })),
+
   takeDamage: (amount) => set((state) => ({
     playerStats: {
       ...state.playerStats,
@@ -129,7 +135,9 @@ export const useGameStore = create((set, get) => ({
 
   isEntityCompleted: (entityId) => get().completedEntities.includes(entityId),
 
-  clearChatHistory: () => set({ chatHistory: [] }),
+  setTutorSessionId: (sessionId) => set({ tutorSessionId: sessionId }),
+
+  clearChatHistory: () => set({ chatHistory: [], tutorSessionId: null }),
 
   updateLeaderboard: (scores) => set({ leaderboard: scores }),
 
@@ -160,7 +168,9 @@ export const useGameStore = create((set, get) => ({
     showQuestion: false,
     currentEntity: null,
     wrongAnswers: [],
+    answerLog: [],
     chatHistory: [],
+    tutorSessionId: null,
     weakTopics: [],
     completedEntities: [],
     attemptedEntities: [],
@@ -179,6 +189,7 @@ export const useGameStore = create((set, get) => ({
     showQuestion: false,
     currentEntity: null,
     wrongAnswers: [],
+    answerLog: [],
     completedEntities: [],
     attemptedEntities: [],
     gameStarted: false,